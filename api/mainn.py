@@ -1,11 +1,17 @@
-from fastapi import FastAPI, File, UploadFile, HTTPException, BackgroundTasks
-from fastapi.responses import JSONResponse, FileResponse
+from fastapi import FastAPI, File, UploadFile, HTTPException, BackgroundTasks, Query
+from fastapi.responses import FileResponse
+import asyncio
 import os
+import re
 import zipfile
-from io import BytesIO
+import struct
+import hashlib
+import json
+from functools import lru_cache
+from io import BufferedReader, TextIOWrapper
 from pygerber.gerberx3.api.v2 import GerberFile, Project
 import tempfile
-from PIL import Image
+import shutil
 import uuid
 import time
 
@@ -14,45 +20,178 @@ app = FastAPI()
 # Constant for dots per millimeter
 DPMM = 40
 
+# Requested resolutions are lowered so no board image is wider or taller than this
+MAX_IMAGE_SIDE_PX = 4000
+
+# Buffer size used when decompressing Gerber files from the ZIP
+READ_BUFFER_SIZE = 32 * 1024
+
+# Gerber files are recognised by extension, including the Protel-style ones
+# KiCad and Altium emit. Top-side layers are recognised by KiCad's F_/F. layer
+# names, a whole "top" word in the name (not laptop), or a .gt? extension.
+# Both are matched against the lowercased file name
+GERBER_EXTENSIONS = ('.gbr', '.gtl', '.gto', '.gts', '.gtp', '.gbl', '.gbo', '.gbs', '.gbp')
+TOP_LAYER_RE = re.compile(r'(^|[-_.])f[._](cu|mask|paste|silks?(creen)?)|(^|[-_. ])top([-_. ]|$)|\.gt[lops]$')
+
+# Uploads are checked against these limits using the sizes recorded in the ZIP
+# directory, before anything is decompressed. zipfile never returns more than the
+# recorded size for a member, so a lying header cannot get past them
+MAX_ZIP_ENTRIES = 500
+MAX_GERBER_BYTES = 200 * 1024 * 1024
+
+# Rendered images are cached on disk, keyed by a hash of the uploaded ZIP.
+# Serverless /tmp is capped at 512 MB, so keep the cache well below that.
+CACHE_DIR = "/tmp/gerber_cache"
+CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+# BLAKE3 hashes several times faster than SHA-256; it is used when installed
+try:
+    from blake3 import blake3 as _new_digest
+except ImportError:
+    _new_digest = hashlib.sha256
+
 # Temporary storage directory
 TEMP_DIR = "/tmp/gerber_images"
 os.makedirs(TEMP_DIR, exist_ok=True)
 
-def pixels_to_mm(pixels):
-    return round(pixels / DPMM)
+# Image sizes repeat across requests, so remember the conversions
+@lru_cache(maxsize=4096)
+def pixels_to_mm(pixels, dpmm=DPMM):
+    return round(pixels / dpmm)
+
+def png_size(path):
+    # PNG stores width and height as big-endian uint32s in the IHDR chunk at offset 16
+    with open(path, 'rb') as f:
+        f.seek(16)
+        return struct.unpack('>II', f.read(8))
+
+def _cap_dpmm(dpmm, extent_mm):
+    if extent_mm > 0:
+        dpmm = min(dpmm, int(MAX_IMAGE_SIDE_PX / extent_mm))
+    return max(dpmm, 1)
+
+def _render(project, path, dpmm):
+    # Render at the requested resolution unless the board is too large for it,
+    # and return the resolution actually used
+    parsed = project.parse()
+    infos = [parsed_file.get_info() for parsed_file in parsed.files]
+    width_mm = max(info.max_x_mm for info in infos) - min(info.min_x_mm for info in infos)
+    height_mm = max(info.max_y_mm for info in infos) - min(info.min_y_mm for info in infos)
+    dpmm = _cap_dpmm(dpmm, max(width_mm, height_mm))
+    parsed.render_raster(path, dpmm=dpmm)
+    return dpmm
+
+def _read_gerber(zip_file, zip_info):
+    # Opening by ZipInfo skips the central directory lookup done for names
+    with BufferedReader(zip_file.open(zip_info), buffer_size=READ_BUFFER_SIZE) as fh:
+        # Gerber is an ASCII format; surrogateescape keeps stray bytes in comments intact
+        return GerberFile.from_buffer(TextIOWrapper(fh, encoding='ascii', errors='surrogateescape'))
 
 def process_gerber_files(zip_file):
+    zip_infos = zip_file.infolist()
+    if len(zip_infos) >= MAX_ZIP_ENTRIES:
+        raise HTTPException(status_code=413, detail="Too many files in ZIP")
+
     top_layer_files = []
     bottom_layer_files = []
+    total_size = 0
 
-    for file_name in zip_file.namelist():
-        if file_name.endswith('.gbr'):
-            if 'Top' in file_name:
-                top_layer_files.append(file_name)
+    for zip_info in zip_infos:
+        file_name = os.path.basename(zip_info.filename).lower()
+        if file_name.endswith(GERBER_EXTENSIONS):
+            total_size += zip_info.file_size
+            if TOP_LAYER_RE.search(file_name):
+                top_layer_files.append(zip_info)
             else:
-                bottom_layer_files.append(file_name)
+                bottom_layer_files.append(zip_info)
+
+    if total_size > MAX_GERBER_BYTES:
+        raise HTTPException(status_code=413, detail="ZIP too large")
 
     if not top_layer_files and not bottom_layer_files:
         raise ValueError("No valid Gerber files found in the ZIP file")
 
     top_project = Project(
         [
-            GerberFile.from_str(
-                zip_file.read(file_name).decode(),
-            ) for file_name in top_layer_files
+            _read_gerber(zip_file, zip_info) for zip_info in top_layer_files
         ]
     ) if top_layer_files else None
 
     bottom_project = Project(
         [
-            GerberFile.from_str(
-                zip_file.read(file_name).decode(),
-            ) for file_name in bottom_layer_files
+            _read_gerber(zip_file, zip_info) for zip_info in bottom_layer_files
         ]
     ) if bottom_layer_files else None
 
     return top_project, bottom_project
 
+def _spool_upload(src, spool):
+    # Hash the upload as it is copied, so the spool isn't read back just to hash it
+    digest = _new_digest()
+    for chunk in iter(lambda: src.read(1024 * 1024), b""):
+        digest.update(chunk)
+        spool.write(chunk)
+    return digest.hexdigest()
+
+def _load_cached(digest, layer_outputs):
+    # Returns the resolution of each cached image, or None on a miss
+    cache_dir = os.path.join(CACHE_DIR, digest)
+    # Another process may evict the entry while it is being copied, which is a miss
+    try:
+        with open(os.path.join(cache_dir, "dpmm.json")) as f:
+            image_dpmm = json.load(f)
+        # Only sides with Gerber layers have an image, and a resolution
+        for cache_name, output_file in layer_outputs:
+            if cache_name in image_dpmm:
+                shutil.copyfile(os.path.join(cache_dir, cache_name), output_file)
+        # Mark the entry as recently used for eviction
+        os.utime(cache_dir)
+    except FileNotFoundError:
+        return None
+    return image_dpmm
+
+def _store_cached(digest, layer_outputs, image_dpmm):
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    staging_dir = tempfile.mkdtemp(prefix=".", dir=CACHE_DIR)
+    for cache_name, output_file in layer_outputs:
+        if os.path.exists(output_file):
+            shutil.copyfile(output_file, os.path.join(staging_dir, cache_name))
+    # Large boards are rendered below the requested resolution, so a hit needs
+    # the resolution each image was rendered at to report its size
+    with open(os.path.join(staging_dir, "dpmm.json"), "w") as f:
+        json.dump(image_dpmm, f)
+    try:
+        os.replace(staging_dir, os.path.join(CACHE_DIR, digest))
+    except OSError:
+        # Another request already cached the same ZIP
+        shutil.rmtree(staging_dir, ignore_errors=True)
+    _evict_cache()
+
+def _evict_cache():
+    entries = []
+    total_size = 0
+    for entry in os.scandir(CACHE_DIR):
+        if entry.name.startswith(".") or not entry.is_dir():
+            continue
+        # Another process may evict the same entry while it is being measured
+        try:
+            size = sum(f.stat().st_size for f in os.scandir(entry.path))
+            last_used = entry.stat().st_mtime
+        except FileNotFoundError:
+            continue
+        entries.append((last_used, size, entry.path))
+        total_size += size
+
+    # Drop least recently used entries until the cache fits. Recency is the
+    # mtime _load_cached sets on every hit; atime would also move whenever this
+    # scan lists an entry, and relatime refreshes it when it is a day old
+    entries.sort()
+    for _, size, path in entries:
+        if total_size <= CACHE_MAX_BYTES:
+            break
+        shutil.rmtree(path, ignore_errors=True)
+        total_size -= size
+
 def cleanup_old_files():
     current_time = time.time()
     for filename in os.listdir(TEMP_DIR):
@@ -61,68 +200,98 @@ def cleanup_old_files():
             if os.stat(file_path).st_mtime < current_time - 3600:  # 1 hour old
                 os.remove(file_path)
 
+# The JSON handlers are annotated "-> dict". From FastAPI 0.130 a declared return
+# type makes FastAPI serialize the response straight to JSON bytes in pydantic-core,
+# instead of going through jsonable_encoder and json.dumps
 @app.post("/api/convert-gerber")
-async def convert_gerber(file: UploadFile = File(...), background_tasks: BackgroundTasks):
+async def convert_gerber(
+    background_tasks: BackgroundTasks,
+    file: UploadFile = File(...),
+    dpmm: int = Query(DPMM, ge=1, le=80),
+) -> dict:
     if not file.filename.endswith('.zip'):
         raise HTTPException(status_code=400, detail="Uploaded file must be a ZIP file")
 
     with tempfile.TemporaryDirectory() as temp_dir:
         try:
-            # Read the uploaded ZIP file
-            zip_content = await file.read()
-            zip_file = zipfile.ZipFile(BytesIO(zip_content))
-
-            # Process the Gerber files
-            top_project, bottom_project = process_gerber_files(zip_file)
-
             # Generate output file paths
             unique_id = str(uuid.uuid4())
             output_top = os.path.join(TEMP_DIR, f"output_top_{unique_id}.png")
             output_bottom = os.path.join(TEMP_DIR, f"output_bottom_{unique_id}.png")
+            layer_outputs = [("output_top.png", output_top), ("output_bottom.png", output_bottom)]
 
-            # Render the top and bottom layers
-            if top_project:
-                top_project.parse().render_raster(output_top, dpmm=DPMM)
-            if bottom_project:
-                bottom_project.parse().render_raster(output_bottom, dpmm=DPMM)
+            # Spool the uploaded ZIP file to disk instead of holding it in memory
+            with tempfile.TemporaryFile() as spool:
+                # Copy and hash in 1 MiB chunks on a worker thread so a large upload doesn't stall the event loop
+                upload_digest = await asyncio.to_thread(_spool_upload, file.file, spool)
+                # The archive now lives in the spool; release the upload's buffer before rendering
+                await file.close()
+
+                # Only the end-of-central-directory record at the tail is read, so non-ZIP
+                # uploads are turned away before the archive is opened
+                if not zipfile.is_zipfile(spool):
+                    raise HTTPException(status_code=400, detail="Uploaded file is not a valid ZIP file")
+
+                # Each requested resolution of an upload is cached separately
+                cache_key = f"{upload_digest}-{dpmm}"
+
+                # Reuse the images rendered for an identical upload, if any
+                image_dpmm = await asyncio.to_thread(_load_cached, cache_key, layer_outputs)
+                if image_dpmm is None:
+                    with zipfile.ZipFile(spool) as zip_file:
+                        # Process the Gerber files
+                        top_project, bottom_project = process_gerber_files(zip_file)
+
+                    # Render the top and bottom layers concurrently, off the event loop
+                    render_jobs = []
+                    if top_project:
+                        render_jobs.append((top_project, "output_top.png", output_top))
+                    if bottom_project:
+                        render_jobs.append((bottom_project, "output_bottom.png", output_bottom))
+                    rendered_dpmm = await asyncio.gather(
+                        *[asyncio.to_thread(_render, project, path, dpmm) for project, _, path in render_jobs]
+                    )
+                    image_dpmm = dict(zip([image_name for _, image_name, _ in render_jobs], rendered_dpmm))
+                    # Copying into the cache also scans it for eviction, so keep it off the event loop
+                    await asyncio.to_thread(_store_cached, cache_key, layer_outputs, image_dpmm)
 
             # Prepare the response
             available_images = []
-            total_width_mm = 0
-            total_height_mm = 0
-            image_count = 0
-
-            for output_file in [output_top, output_bottom]:
-                if os.path.exists(output_file):
-                    with Image.open(output_file) as img:
-                        width_mm = pixels_to_mm(img.width)
-                        height_mm = pixels_to_mm(img.height)
-                        available_images.append({
-                            "name": os.path.basename(output_file),
-                            "width": width_mm,
-                            "height": height_mm,
-                            "url": f"/api/images/{os.path.basename(output_file)}"
-                        })
-                        total_width_mm += width_mm
-                        total_height_mm += height_mm
-                        image_count += 1
+
+            # Only sides with Gerber layers have an image; a missing file is cheaper
+            # to find out about by opening it than with a separate stat
+            for image_name, output_file in layer_outputs:
+                try:
+                    width_px, height_px = png_size(output_file)
+                except FileNotFoundError:
+                    continue
+                width_mm = pixels_to_mm(width_px, image_dpmm[image_name])
+                height_mm = pixels_to_mm(height_px, image_dpmm[image_name])
+                available_images.append({
+                    "name": os.path.basename(output_file),
+                    "width": width_mm,
+                    "height": height_mm,
+                    "url": f"/api/images/{os.path.basename(output_file)}"
+                })
 
             # Calculate average dimensions
-            avg_width_mm = round(total_width_mm / image_count) if image_count > 0 else 0
-            avg_height_mm = round(total_height_mm / image_count) if image_count > 0 else 0
+            avg_width_mm = round(sum(image["width"] for image in available_images) / len(available_images)) if available_images else 0
+            avg_height_mm = round(sum(image["height"] for image in available_images) / len(available_images)) if available_images else 0
 
             # Schedule cleanup task
             background_tasks.add_task(cleanup_old_files)
 
-            return JSONResponse(content={
+            return {
                 "message": "Gerber files processed successfully",
                 "available_images": available_images,
                 "average_dimensions": {
                     "width": avg_width_mm,
                     "height": avg_height_mm
                 }
-            })
+            }
 
+        except HTTPException:
+            raise
         except ValueError as ve:
             raise HTTPException(status_code=400, detail=str(ve))
         except Exception as e:
@@ -131,16 +300,26 @@ async def convert_gerber(file: UploadFile = File(...), background_tasks: Backgro
 @app.get("/api/images/{image_name}")
 async def get_image(image_name: str, background_tasks: BackgroundTasks):
     image_path = os.path.join(TEMP_DIR, image_name)
-    if not os.path.exists(image_path):
+    # Stat once here and hand the result to FileResponse so it doesn't stat again
+    try:
+        stat_result = os.stat(image_path)
+    except FileNotFoundError:
         raise HTTPException(status_code=404, detail="Image not found")
     
     # Schedule cleanup task
     background_tasks.add_task(cleanup_old_files)
     
-    return FileResponse(image_path, media_type="image/png", filename=image_name)
+    # Image names are unique per conversion, so browsers can keep them
+    return FileResponse(
+        image_path,
+        media_type="image/png",
+        filename=image_name,
+        stat_result=stat_result,
+        headers={"Cache-Control": "public, max-age=3600, immutable"},
+    )
 
 @app.get("/api/list-images")
-async def list_images(background_tasks: BackgroundTasks):
+async def list_images(background_tasks: BackgroundTasks) -> dict:
     images = []
     for filename in os.listdir(TEMP_DIR):
         if filename.endswith('.png'):
@@ -152,4 +331,4 @@ async def list_images(background_tasks: BackgroundTasks):
     # Schedule cleanup task
     background_tasks.add_task(cleanup_old_files)
     
-    return JSONResponse(content={"available_images": images})
+    return {"available_images": images}
@@ -1,10 +1,19 @@
 from flask import Flask, request, jsonify
+import os
+import re
 import zipfile
 from io import BytesIO
 from pygerber.gerberx3.api.v2 import GerberFile, Project
 
 app = Flask(__name__)
 
+# Gerber files are recognised by extension, including the Protel-style ones
+# KiCad and Altium emit. Top-side layers are recognised by KiCad's F_/F. layer
+# names, a whole "top" word in the name (not laptop), or a .gt? extension.
+# Both are matched against the lowercased file name, which is built once per entry
+GERBER_EXTENSIONS = ('.gbr', '.gtl', '.gto', '.gts', '.gtp', '.gbl', '.gbo', '.gbs', '.gbp')
+TOP_LAYER_RE = re.compile(r'(^|[-_.])f[._](cu|mask|paste|silks?(creen)?)|(^|[-_. ])top([-_. ]|$)|\.gt[lops]$')
+
 @app.route('/process-gerber', methods=['POST'])
 def process_gerber():
     uploaded_file = request.files['zip_file']
@@ -14,11 +23,13 @@ def process_gerber():
     # Open the ZIP file
     with zipfile.ZipFile(uploaded_file, 'r') as zip_file:
         for file_name in zip_file.namelist():
-            if file_name.endswith('.gbr'):
-                if 'Top' in file_name:
-                    top_layer_files.append(file_name)
-                else:
-                    bottom_layer_files.append(file_name)
+            lower_name = os.path.basename(file_name).lower()
+            if not lower_name.endswith(GERBER_EXTENSIONS):
+                continue
+            if TOP_LAYER_RE.search(lower_name):
+                top_layer_files.append(file_name)
+            else:
+                bottom_layer_files.append(file_name)
 
         top_project = Project(
             [GerberFile.from_str(zip_file.read(file_name).decode()) for file_name in top_layer_files]
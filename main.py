@@ -1,188 +1,726 @@
-from fastapi import FastAPI, File, UploadFile, HTTPException
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi import FastAPI, File, UploadFile, HTTPException, BackgroundTasks, Query
+from fastapi.responses import StreamingResponse
+from fastapi.staticfiles import StaticFiles
+import asyncio
 import os
 import zipfile
-from io import BytesIO
-from pygerber.gerberx3.api.v2 import GerberFile, Project
+import struct
+import hashlib
+import zlib
+from functools import lru_cache, partial
+from io import BufferedReader, TextIOWrapper
+from concurrent.futures import ProcessPoolExecutor
+from pygerber.gerberx3.api.v2 import DEFAULT_ALPHA_COLOR_MAP, GerberFile
+from pygerber.gerberx3.renderer2.raster import RasterRenderer2, RasterRenderer2Hooks
 import tempfile
 import shutil
+import re
+import uuid
+from collections import OrderedDict
+from typing import List, Optional
 from PIL import Image
 import math
 
 app = FastAPI()
 
-# Global variable to store the path of the output directory
-OUTPUT_DIR = None
+# Each conversion renders into its own directory under OUTPUT_ROOT, addressed by
+# a job id. Only the MAX_JOBS most recently used directories are kept
+OUTPUT_ROOT = "/tmp/gerber"
+MAX_JOBS = 100
+JOBS = OrderedDict()
+JOB_ID_RE = re.compile(r"[0-9a-f]{32}")
+
+# Image listings of the jobs in JOBS, recorded when they are rendered so
+# /list-images/ doesn't have to scan and read the PNGs again
+IMAGE_INDEX = {}
 
 # Constant for dots per millimeter
 DPMM = 40
 
-def pixels_to_mm(pixels):
-    return round(pixels / DPMM)
+# Requested resolutions are lowered so no board image is wider or taller than this
+MAX_IMAGE_SIDE_PX = 4000
+
+# Buffer size used when decompressing Gerber files from the ZIP
+READ_BUFFER_SIZE = 32 * 1024
+
+# Gerber files are recognised by extension, including the Protel-style ones
+# KiCad and Altium emit. Top-side layers are recognised by KiCad's F_/F. layer
+# names, a whole "top" word in the name (not laptop), or a .gt? extension.
+# Both are matched against the lowercased file name
+GERBER_EXTENSIONS = ('.gbr', '.gtl', '.gto', '.gts', '.gtp', '.gbl', '.gbo', '.gbs', '.gbp')
+TOP_LAYER_RE = re.compile(r'(^|[-_.])f[._](cu|mask|paste|silks?(creen)?)|(^|[-_. ])top([-_. ]|$)|\.gt[lops]$')
+
+# Uploads are checked against these limits using the sizes recorded in the ZIP
+# directory, before anything is decompressed. zipfile never returns more than the
+# recorded size for a member, so a lying header cannot get past them. Gerber files
+# uploaded individually are held to the same limits
+MAX_ZIP_ENTRIES = 500
+MAX_GERBER_BYTES = 200 * 1024 * 1024
+
+# Rendered images are cached on disk, keyed by a hash of the uploaded ZIP
+CACHE_DIR = "/tmp/gerber_cache"
+CACHE_MAX_BYTES = 2 * 1024 * 1024 * 1024
+
+# BLAKE3 hashes several times faster than SHA-256; it is used when installed
+try:
+    from blake3 import blake3 as _new_digest
+except ImportError:
+    _new_digest = hashlib.sha256
+
+# Cores this process may run on. A container's cpuset or a taskset can leave it
+# fewer than os.cpu_count() reports, and cpu_count() can return None
+if hasattr(os, "sched_getaffinity"):
+    CPU_COUNT = len(os.sched_getaffinity(0))
+else:
+    CPU_COUNT = os.cpu_count() or 1
+
+# Every uvicorn worker has its own pool of processes that rasterize individual
+# Gerber layers in parallel. The cores are split between them so that all the
+# workers rendering at once use about one process per core
+WEB_WORKERS = max(2, CPU_COUNT // 2)
+RENDER_WORKERS = max(1, CPU_COUNT // WEB_WORKERS)
+RENDER_POOL = ProcessPoolExecutor(RENDER_WORKERS)
+
+# Image sizes repeat across requests, so remember the conversions
+@lru_cache(maxsize=4096)
+def pixels_to_mm(pixels, dpmm=DPMM):
+    return round(pixels / dpmm)
+
+def png_header(path):
+    # PNG stores width and height as big-endian uint32s in the IHDR chunk at offset 16.
+    # Boards also record their resolution in a pHYs chunk (pixels per metre) ahead of
+    # the image data; the file is buffered, so finding it rarely costs another read
+    with open(path, 'rb') as f:
+        f.seek(16)
+        width, height = struct.unpack('>II', f.read(8))
+        dpmm = DPMM
+        # Skip the rest of IHDR: 13 bytes of data and a 4-byte CRC
+        f.seek(33)
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                break
+            length, chunk_type = struct.unpack('>I4s', header)
+            if chunk_type == b'pHYs':
+                pixels_per_unit, _, unit = struct.unpack('>IIB', f.read(9))
+                if unit == 1:
+                    dpmm = round(pixels_per_unit / 1000)
+                break
+            if chunk_type == b'IDAT':
+                break
+            f.seek(length + 4, 1)
+    return width, height, dpmm
+
+def _cap_dpmm(dpmm, extent_mm):
+    if extent_mm > 0:
+        dpmm = min(dpmm, int(MAX_IMAGE_SIDE_PX / extent_mm))
+    return max(dpmm, 1)
+
+def _render_layer(gerber_file, dpmm):
+    parsed_file = gerber_file.parse()
+    info = parsed_file.get_info()
+    dpmm = _cap_dpmm(dpmm, max(info.width_mm, info.height_mm))
+    # ParsedFile.render_raster can only hand the image back PNG-encoded, which
+    # takes longer than rasterizing it, so render the way it does and keep the
+    # image. The pixels go back to the parent deflated at level 1: nearly as
+    # cheap as sending them raw, and a fraction of the size, since layers are
+    # mostly empty
+    layer = RasterRenderer2(
+        RasterRenderer2Hooks(color_scheme=DEFAULT_ALPHA_COLOR_MAP[parsed_file.get_file_type()], dpmm=dpmm),
+    ).render(parsed_file._command_buffer).get_image()
+    if layer.mode != "RGBA":
+        layer = layer.convert("RGBA")
+    return info, dpmm, (layer.size, zlib.compress(layer.tobytes(), 1))
+
+def _board_dpmm(layers, dpmm):
+    # The board spans all of its layers, so it may need a lower resolution than
+    # any single layer was capped to
+    width_mm = max(info.max_x_mm for info, _, _ in layers) - min(info.min_x_mm for info, _, _ in layers)
+    height_mm = max(info.max_y_mm for info, _, _ in layers) - min(info.min_y_mm for info, _, _ in layers)
+    return _cap_dpmm(dpmm, max(width_mm, height_mm))
+
+def _composite(layers, dpmm, path):
+    # Stack the rasterized layers, all rendered at dpmm, onto one board image
+    # the same way ParsedProject.render_raster does
+    min_x_mm = min(info.min_x_mm for info, _, _ in layers)
+    min_y_mm = min(info.min_y_mm for info, _, _ in layers)
+    max_x_mm = max(info.max_x_mm for info, _, _ in layers)
+    max_y_mm = max(info.max_y_mm for info, _, _ in layers)
+
+    # The board's alpha channel would be dropped before saving anyway, so blend
+    # straight onto black RGB: same pixels, without holding an RGBA board and an
+    # RGB copy of it at the same time
+    board = Image.new(
+        "RGB",
+        (int((max_x_mm - min_x_mm) * dpmm), int((max_y_mm - min_y_mm) * dpmm)),
+        (0, 0, 0),
+    )
+    for info, _, (size, pixels) in layers:
+        layer = Image.frombuffer("RGBA", size, zlib.decompress(pixels), "raw", "RGBA", 0, 1)
+        offset = (int((info.min_x_mm - min_x_mm) * dpmm), int((max_y_mm - info.max_y_mm) * dpmm))
+        board.paste(layer, offset, layer)
+    # Favour encode speed on the request path; _recompress_png shrinks it later.
+    # The resolution goes into the pHYs chunk so png_header can read it back
+    _to_palette(board).save(path, "PNG", compress_level=1, dpi=(dpmm * 25.4, dpmm * 25.4))
+
+def _to_palette(image):
+    # Boards only use a handful of flat colours. Mapping them onto an exact
+    # palette lets the PNG encoder write 1-4 bits per pixel instead of 24
+    colors = image.getcolors(256)
+    if colors is None:
+        return image
+    palette = Image.new("P", (1, 1))
+    palette.putpalette([channel for _, rgb in colors for channel in rgb])
+    return image.quantize(palette=palette, dither=Image.Dither.NONE)
+
+def _recompress_png(path):
+    staging_path = path + ".tmp"
+    with Image.open(path) as image:
+        image.save(staging_path, "PNG", optimize=True, dpi=image.info.get("dpi"))
+    os.replace(staging_path, path)
+
+def _finish_render(digest, layer_outputs):
+    for _, output_file in layer_outputs:
+        if os.path.exists(output_file):
+            _recompress_png(output_file)
+    _store_cached(digest, layer_outputs)
+
+async def _render_layers(read_gerber, render_jobs, dpmm):
+    # Three-stage pipeline: a thread reads (and decompresses) Gerber files into a
+    # bounded queue, the process pool parses and rasterizes each layer as soon as
+    # it arrives, and each board is composited once all of its layers are done
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue(maxsize=2)
+    slots = asyncio.Semaphore(RENDER_WORKERS)
+    layer_futures = {path: [] for _, path in render_jobs}
+    layer_sources = {path: [] for _, path in render_jobs}
+
+    async def decompress():
+        for sources, path in render_jobs:
+            for source in sources:
+                gerber_file = await asyncio.to_thread(read_gerber, source)
+                await queue.put((path, gerber_file))
+        await queue.put(None)
+
+    async def rasterize(gerber_file, layer_dpmm):
+        try:
+            return await loop.run_in_executor(RENDER_POOL, _render_layer, gerber_file, layer_dpmm)
+        finally:
+            slots.release()
+
+    async def dispatch():
+        while (item := await queue.get()) is not None:
+            path, gerber_file = item
+            await slots.acquire()
+            layer_sources[path].append(gerber_file)
+            layer_futures[path].append(asyncio.ensure_future(rasterize(gerber_file, dpmm)))
+
+    async def composite(path, futures, sources):
+        layers = list(await asyncio.gather(*futures))
+        # Each layer is capped on its own extent. When the board as a whole needs
+        # a lower resolution, the layers that came back at another one are
+        # rendered again rather than resampled, which would alias them. Boards
+        # within the cap never get here
+        board_dpmm = _board_dpmm(layers, dpmm)
+        redo = [index for index, (_, layer_dpmm, _) in enumerate(layers) if layer_dpmm != board_dpmm]
+        for index in redo:
+            await slots.acquire()
+            futures.append(asyncio.ensure_future(rasterize(sources[index], board_dpmm)))
+        for index, layer in zip(redo, await asyncio.gather(*futures[len(layers):])):
+            layers[index] = layer
+        # Shielded, so a failure elsewhere waits for the image to be written
+        # instead of leaving its thread to finish after the error is reported
+        write = asyncio.ensure_future(asyncio.to_thread(_composite, layers, board_dpmm, path))
+        writes.append(write)
+        await asyncio.shield(write)
+
+    stages = [asyncio.ensure_future(decompress()), asyncio.ensure_future(dispatch())]
+    composites = []
+    writes = []
+    try:
+        await asyncio.gather(*stages)
+        composites = [
+            asyncio.ensure_future(composite(path, futures, layer_sources[path]))
+            for path, futures in layer_futures.items()
+        ]
+        await asyncio.gather(*composites)
+    finally:
+        # gather re-raises the first failure without stopping the rest, so cancel
+        # everything still queued or rendering, then let a board image that is
+        # already being written finish before the error is reported
+        for future in stages + composites + [future for futures in layer_futures.values() for future in futures]:
+            future.cancel()
+        await asyncio.gather(*composites, *writes, return_exceptions=True)
+
+def _read_gerber(zip_file, zip_info):
+    # Opening by ZipInfo skips the central directory lookup done for names
+    with BufferedReader(zip_file.open(zip_info), buffer_size=READ_BUFFER_SIZE) as fh:
+        # Gerber is an ASCII format; surrogateescape keeps stray bytes in comments intact
+        return GerberFile.from_buffer(TextIOWrapper(fh, encoding='ascii', errors='surrogateescape'))
+
+def _read_upload(upload):
+    # SpooledTemporaryFile has no readable() before Python 3.11, so it can't be
+    # wrapped in a TextIOWrapper; uploaded Gerber files are small enough to decode whole
+    upload.file.seek(0)
+    return GerberFile.from_str(upload.file.read().decode('ascii', 'surrogateescape'))
 
 def process_gerber_files(zip_file):
+    zip_infos = zip_file.infolist()
+    if len(zip_infos) >= MAX_ZIP_ENTRIES:
+        raise HTTPException(status_code=413, detail="Too many files in ZIP")
+
     top_layer_files = []
     bottom_layer_files = []
+    total_size = 0
 
-    for file_name in zip_file.namelist():
-        if file_name.endswith('.gbr'):
-            if 'Top' in file_name:
-                top_layer_files.append(file_name)
+    for zip_info in zip_infos:
+        file_name = os.path.basename(zip_info.filename).lower()
+        if file_name.endswith(GERBER_EXTENSIONS):
+            total_size += zip_info.file_size
+            if TOP_LAYER_RE.search(file_name):
+                top_layer_files.append(zip_info)
             else:
-                bottom_layer_files.append(file_name)
+                bottom_layer_files.append(zip_info)
+
+    if total_size > MAX_GERBER_BYTES:
+        raise HTTPException(status_code=413, detail="ZIP too large")
 
     if not top_layer_files and not bottom_layer_files:
         raise ValueError("No valid Gerber files found in the ZIP file")
 
-    top_project = Project(
-        [
-            GerberFile.from_str(
-                zip_file.read(file_name).decode(),
-            ) for file_name in top_layer_files
-        ]
-    ) if top_layer_files else None
+    return top_layer_files, bottom_layer_files
 
-    bottom_project = Project(
-        [
-            GerberFile.from_str(
-                zip_file.read(file_name).decode(),
-            ) for file_name in bottom_layer_files
-        ]
-    ) if bottom_layer_files else None
+def process_gerber_uploads(files):
+    if len(files) >= MAX_ZIP_ENTRIES:
+        raise HTTPException(status_code=413, detail="Too many files uploaded")
+
+    top_layer_files = []
+    bottom_layer_files = []
+    total_size = 0
+
+    for upload in files:
+        file_name = os.path.basename(upload.filename or "").lower()
+        if file_name.endswith(GERBER_EXTENSIONS):
+            total_size += upload.size or 0
+            if TOP_LAYER_RE.search(file_name):
+                top_layer_files.append(upload)
+            else:
+                bottom_layer_files.append(upload)
+
+    if total_size > MAX_GERBER_BYTES:
+        raise HTTPException(status_code=413, detail="Upload too large")
+
+    if not top_layer_files and not bottom_layer_files:
+        raise ValueError("No valid Gerber files found in the upload")
+
+    return top_layer_files, bottom_layer_files
+
+def _hash_file(fh):
+    fh.seek(0)
+    if hasattr(hashlib, "file_digest"):
+        digest = hashlib.file_digest(fh, _new_digest)
+    else:
+        digest = _new_digest()
+        for chunk in iter(lambda: fh.read(1024 * 1024), b""):
+            digest.update(chunk)
+    fh.seek(0)
+    return digest.hexdigest()
+
+def _spool_upload(src, spool):
+    # Hash the upload as it is copied, so the spool isn't read back just to hash it
+    digest = _new_digest()
+    for chunk in iter(lambda: src.read(1024 * 1024), b""):
+        digest.update(chunk)
+        spool.write(chunk)
+    return digest.hexdigest()
+
+def _hash_uploads(files):
+    # Hash names along with contents, since the name decides a file's side
+    digest = _new_digest()
+    for upload in files:
+        digest.update(f"{upload.filename}\0{_hash_file(upload.file)}\n".encode())
+    return digest.hexdigest()
+
+def _load_cached(digest, layer_outputs):
+    cache_dir = os.path.join(CACHE_DIR, digest)
+    copied = False
+    # Another process may evict the entry while it is being copied, which is a miss
+    try:
+        for cache_name, output_file in layer_outputs:
+            # Sides without Gerber layers have no image
+            try:
+                shutil.copyfile(os.path.join(cache_dir, cache_name), output_file)
+            except FileNotFoundError:
+                continue
+            copied = True
+        # Mark the entry as recently used for eviction
+        os.utime(cache_dir)
+    except FileNotFoundError:
+        return False
+    return copied
+
+def _store_cached(digest, layer_outputs):
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    staging_dir = tempfile.mkdtemp(prefix=".", dir=CACHE_DIR)
+    for cache_name, output_file in layer_outputs:
+        if os.path.exists(output_file):
+            shutil.copyfile(output_file, os.path.join(staging_dir, cache_name))
+    try:
+        os.replace(staging_dir, os.path.join(CACHE_DIR, digest))
+    except OSError:
+        # Another request already cached the same ZIP
+        shutil.rmtree(staging_dir, ignore_errors=True)
+    _evict_cache()
+
+def _evict_cache():
+    entries = []
+    total_size = 0
+    for entry in os.scandir(CACHE_DIR):
+        if entry.name.startswith(".") or not entry.is_dir():
+            continue
+        # Another process may evict the same entry while it is being measured
+        try:
+            size = sum(f.stat().st_size for f in os.scandir(entry.path))
+            last_used = entry.stat().st_mtime
+        except FileNotFoundError:
+            continue
+        entries.append((last_used, size, entry.path))
+        total_size += size
+
+    # Drop least recently used entries until the cache fits. Recency is the
+    # mtime _load_cached sets on every hit; atime would also move whenever this
+    # scan lists an entry, and relatime refreshes it when it is a day old
+    entries.sort()
+    for _, size, path in entries:
+        if total_size <= CACHE_MAX_BYTES:
+            break
+        shutil.rmtree(path, ignore_errors=True)
+        total_size -= size
+
+def _remove_job_dir(output_dir):
+    # Job directories only hold a few images, so unlinking them directly
+    # is cheaper than having rmtree walk and stat the tree
+    try:
+        with os.scandir(output_dir) as entries:
+            for entry in entries:
+                os.unlink(entry.path)
+        os.rmdir(output_dir)
+    except OSError:
+        pass
+
+def _create_job():
+    job_id = uuid.uuid4().hex
+    output_dir = os.path.join(OUTPUT_ROOT, job_id)
+    os.makedirs(output_dir)
+    JOBS[job_id] = output_dir
+    while len(JOBS) > MAX_JOBS:
+        stale_id, stale_dir = JOBS.popitem(last=False)
+        IMAGE_INDEX.pop(stale_id, None)
+        _remove_job_dir(stale_dir)
+    return job_id, output_dir
+
+def _job_dir(job_id):
+    # Job ids come from the URL, so only accept the form _create_job generates
+    if not JOB_ID_RE.fullmatch(job_id):
+        raise HTTPException(status_code=404, detail="Unknown job")
+    if job_id in JOBS:
+        JOBS.move_to_end(job_id)
+    return os.path.join(OUTPUT_ROOT, job_id)
+
+def _latest_job():
+    # Each worker process only knows its own jobs, so the most recent one is the
+    # job directory written to last
+    latest_id, latest_mtime = None, 0
+    with os.scandir(OUTPUT_ROOT) as entries:
+        for entry in entries:
+            if not JOB_ID_RE.fullmatch(entry.name):
+                continue
+            # Another process may evict the job while it is being looked at
+            try:
+                mtime = entry.stat().st_mtime
+            except FileNotFoundError:
+                continue
+            if mtime > latest_mtime:
+                latest_id, latest_mtime = entry.name, mtime
+    return latest_id
+
+def _index_job(job_id, layer_outputs):
+    # Describe a job's rendered images and remember the listing in IMAGE_INDEX
+    available_images = []
+
+    # Only sides with Gerber layers have an image; a missing file is cheaper
+    # to find out about by opening it than with a separate stat
+    for image_name, output_file in layer_outputs:
+        try:
+            width_px, height_px, image_dpmm = png_header(output_file)
+        except FileNotFoundError:
+            continue
+        width_mm = pixels_to_mm(width_px, image_dpmm)
+        height_mm = pixels_to_mm(height_px, image_dpmm)
+        available_images.append({
+            "name": image_name,
+            "width": width_mm,
+            "height": height_mm
+        })
+
+    # Calculate average dimensions
+    avg_width_mm = round(sum(image["width"] for image in available_images) / len(available_images)) if available_images else 0
+    avg_height_mm = round(sum(image["height"] for image in available_images) / len(available_images)) if available_images else 0
+
+    IMAGE_INDEX[job_id] = {
+        "available_images": available_images,
+        "average_dimensions": {
+            "width": avg_width_mm,
+            "height": avg_height_mm
+        }
+    }
+
+    return IMAGE_INDEX[job_id]
+
+async def _convert_zip(file, output_dir, dpmm, background_tasks):
+    # Render an uploaded ZIP into output_dir and return its layer outputs
+    output_top = os.path.join(output_dir, "output_top.png")
+    output_bottom = os.path.join(output_dir, "output_bottom.png")
+    layer_outputs = [("output_top.png", output_top), ("output_bottom.png", output_bottom)]
+
+    # Spool the uploaded ZIP file to disk instead of holding it in memory
+    with tempfile.TemporaryFile() as spool:
+        # Copy and hash in 1 MiB chunks on a worker thread so a large upload doesn't stall the event loop
+        upload_digest = await asyncio.to_thread(_spool_upload, file.file, spool)
+        # The archive now lives in the spool; release the upload's buffer before rendering
+        await file.close()
+
+        # Only the end-of-central-directory record at the tail is read, so non-ZIP
+        # uploads are turned away before the archive is opened
+        if not zipfile.is_zipfile(spool):
+            raise HTTPException(status_code=400, detail="Uploaded file is not a valid ZIP file")
 
-    return top_project, bottom_project
+        # Each requested resolution of an upload is cached separately
+        cache_key = f"{upload_digest}-{dpmm}"
 
+        # Reuse the images rendered for an identical upload, if any
+        if not await asyncio.to_thread(_load_cached, cache_key, layer_outputs):
+            with zipfile.ZipFile(spool) as zip_file:
+                # Find the Gerber files for each side
+                top_layer_files, bottom_layer_files = process_gerber_files(zip_file)
+
+                # Decompress, rasterize and composite both sides off the event loop
+                render_jobs = []
+                if top_layer_files:
+                    render_jobs.append((top_layer_files, output_top))
+                if bottom_layer_files:
+                    render_jobs.append((bottom_layer_files, output_bottom))
+                await _render_layers(partial(_read_gerber, zip_file), render_jobs, dpmm)
+
+            # Recompress and cache the images once the response has been sent
+            background_tasks.add_task(_finish_render, cache_key, layer_outputs)
+
+    return layer_outputs
+
+def _build_zip(layer_outputs):
+    # The archive is built in a seekable file so zipfile can put each entry's
+    # sizes in its local header. Written to a stream, stored entries get a data
+    # descriptor instead, which readers such as Java's ZipInputStream reject.
+    # Bundles usually fit in memory; larger ones roll over to disk
+    bundle = tempfile.SpooledTemporaryFile(max_size=16 * 1024 * 1024)
+    # PNGs are already deflated, so they are stored as they are
+    with zipfile.ZipFile(bundle, "w", zipfile.ZIP_STORED) as archive:
+        for image_name, output_file in layer_outputs:
+            try:
+                archive.write(output_file, image_name)
+            except FileNotFoundError:
+                continue
+    bundle.seek(0)
+    return bundle
+
+# The JSON handlers are annotated "-> dict". From FastAPI 0.130 a declared return
+# type makes FastAPI serialize the response straight to JSON bytes in pydantic-core,
+# instead of going through jsonable_encoder and json.dumps
 @app.post("/convert-gerber/")
-async def convert_gerber(file: UploadFile = File(...)):
-    global OUTPUT_DIR
+async def convert_gerber(
+    background_tasks: BackgroundTasks,
+    file: UploadFile = File(...),
+    dpmm: int = Query(DPMM, ge=1, le=80),
+) -> dict:
     if not file.filename.endswith('.zip'):
         raise HTTPException(status_code=400, detail="Uploaded file must be a ZIP file")
 
     # Create a new output directory for this conversion
-    OUTPUT_DIR = tempfile.mkdtemp()
+    job_id, output_dir = _create_job()
+
+    try:
+        layer_outputs = await _convert_zip(file, output_dir, dpmm, background_tasks)
+
+        return {
+            "message": "Gerber files processed successfully",
+            "job_id": job_id,
+            **_index_job(job_id, layer_outputs)
+        }
+
+    except HTTPException:
+        raise
+    except ValueError as ve:
+        raise HTTPException(status_code=400, detail=str(ve))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"An error occurred: {str(e)}")
+
+@app.post("/convert-gerber-bundle/")
+async def convert_gerber_bundle(
+    background_tasks: BackgroundTasks,
+    file: UploadFile = File(...),
+    dpmm: int = Query(DPMM, ge=1, le=80),
+):
+    # Same conversion as /convert-gerber/, but the images come back in the
+    # response as a ZIP instead of needing a request each
+    if not file.filename.endswith('.zip'):
+        raise HTTPException(status_code=400, detail="Uploaded file must be a ZIP file")
+
+    job_id, output_dir = _create_job()
 
     try:
-        # Read the uploaded ZIP file
-        zip_content = await file.read()
-        zip_file = zipfile.ZipFile(BytesIO(zip_content))
+        layer_outputs = await _convert_zip(file, output_dir, dpmm, background_tasks)
+        _index_job(job_id, layer_outputs)
+
+        # Build the bundle off the event loop, and close it once it has been sent
+        bundle = await asyncio.to_thread(_build_zip, layer_outputs)
+        background_tasks.add_task(bundle.close)
+
+        return StreamingResponse(
+            iter(lambda: bundle.read(1024 * 1024), b""),
+            media_type="application/zip",
+            headers={"Content-Disposition": "attachment; filename=boards.zip", "X-Job-Id": job_id},
+            background=background_tasks,
+        )
 
-        # Process the Gerber files
-        top_project, bottom_project = process_gerber_files(zip_file)
+    except HTTPException:
+        raise
+    except ValueError as ve:
+        raise HTTPException(status_code=400, detail=str(ve))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"An error occurred: {str(e)}")
 
+@app.post("/convert-gerber-multi/")
+async def convert_gerber_multi(
+    background_tasks: BackgroundTasks,
+    files: List[UploadFile] = File(...),
+    dpmm: int = Query(DPMM, ge=1, le=80),
+) -> dict:
+    # Small boards can be sent as their individual Gerber files, which saves
+    # zipping them on the client and decompressing them here
+    job_id, output_dir = _create_job()
+
+    try:
         # Generate output file paths
-        output_top = os.path.join(OUTPUT_DIR, "output_top.png")
-        output_bottom = os.path.join(OUTPUT_DIR, "output_bottom.png")
-
-        # Render the top and bottom layers
-        if top_project:
-            top_project.parse().render_raster(output_top, dpmm=DPMM)
-        if bottom_project:
-            bottom_project.parse().render_raster(output_bottom, dpmm=DPMM)
-
-        # Prepare the response
-        available_images = []
-        total_width_mm = 0
-        total_height_mm = 0
-        image_count = 0
-
-        if os.path.exists(output_top):
-            with Image.open(output_top) as img:
-                width_mm = pixels_to_mm(img.width)
-                height_mm = pixels_to_mm(img.height)
-                available_images.append({
-                    "name": "output_top.png",
-                    "width": width_mm,
-                    "height": height_mm
-                })
-                total_width_mm += width_mm
-                total_height_mm += height_mm
-                image_count += 1
-
-        if os.path.exists(output_bottom):
-            with Image.open(output_bottom) as img:
-                width_mm = pixels_to_mm(img.width)
-                height_mm = pixels_to_mm(img.height)
-                available_images.append({
-                    "name": "output_bottom.png",
-                    "width": width_mm,
-                    "height": height_mm
-                })
-                total_width_mm += width_mm
-                total_height_mm += height_mm
-                image_count += 1
-
-        # Calculate average dimensions
-        avg_width_mm = round(total_width_mm / image_count) if image_count > 0 else 0
-        avg_height_mm = round(total_height_mm / image_count) if image_count > 0 else 0
-
-        return JSONResponse(content={
+        output_top = os.path.join(output_dir, "output_top.png")
+        output_bottom = os.path.join(output_dir, "output_bottom.png")
+        layer_outputs = [("output_top.png", output_top), ("output_bottom.png", output_bottom)]
+
+        # Find the Gerber files for each side
+        top_layer_files, bottom_layer_files = process_gerber_uploads(files)
+
+        # Hash the uploads on a worker thread; together they can be as large as a ZIP
+        upload_digest = await asyncio.to_thread(_hash_uploads, top_layer_files + bottom_layer_files)
+
+        # Each requested resolution of an upload is cached separately
+        cache_key = f"{upload_digest}-{dpmm}"
+
+        # Reuse the images rendered for identical uploads, if any
+        if not await asyncio.to_thread(_load_cached, cache_key, layer_outputs):
+            # Rasterize and composite both sides off the event loop
+            render_jobs = []
+            if top_layer_files:
+                render_jobs.append((top_layer_files, output_top))
+            if bottom_layer_files:
+                render_jobs.append((bottom_layer_files, output_bottom))
+            await _render_layers(_read_upload, render_jobs, dpmm)
+
+            # Recompress and cache the images once the response has been sent
+            background_tasks.add_task(_finish_render, cache_key, layer_outputs)
+
+        return {
             "message": "Gerber files processed successfully",
-            "available_images": available_images,
-            "average_dimensions": {
-                "width": avg_width_mm,
-                "height": avg_height_mm
-            }
-        })
+            "job_id": job_id,
+            **_index_job(job_id, layer_outputs)
+        }
 
+    except HTTPException:
+        raise
     except ValueError as ve:
         raise HTTPException(status_code=400, detail=str(ve))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"An error occurred: {str(e)}")
 
-@app.get("/images/{image_name}")
-async def get_image(image_name: str):
-    global OUTPUT_DIR
-    if not OUTPUT_DIR:
-        raise HTTPException(status_code=404, detail="No images available. Please convert Gerber files first.")
-    
-    image_path = os.path.join(OUTPUT_DIR, image_name)
-    if not os.path.exists(image_path):
-        raise HTTPException(status_code=404, detail="Image not found")
-    
-    return FileResponse(image_path, media_type="image/png", filename=image_name)
+class _ImageFiles(StaticFiles):
+    # Image URLs are unique per conversion, so browsers can keep them
+    def file_response(self, *args, **kwargs):
+        response = super().file_response(*args, **kwargs)
+        response.headers["Cache-Control"] = "public, max-age=3600, immutable"
+        return response
+
+# Images are served as /images/{job_id}/{image_name} straight from the job
+# directories, without a route handler. StaticFiles checks the directory exists
+os.makedirs(OUTPUT_ROOT, exist_ok=True)
+app.mount("/images", _ImageFiles(directory=OUTPUT_ROOT), name="images")
 
 @app.get("/list-images/")
-async def list_images():
-    global OUTPUT_DIR
-    if not OUTPUT_DIR:
-        return JSONResponse(content={"available_images": []})
+async def list_images(job_id: Optional[str] = None) -> dict:
+    # Without a job id, list the most recent conversion handled by any worker
+    if job_id is None:
+        job_id = _latest_job()
+        if job_id is None:
+            return {"available_images": []}
+
+    output_dir = _job_dir(job_id)
+    if job_id in IMAGE_INDEX:
+        return IMAGE_INDEX[job_id]
+
+    # Jobs rendered by another worker process are only known on disk
+    if not os.path.isdir(output_dir):
+        return {"available_images": []}
     
     available_images = []
-    total_width_mm = 0
-    total_height_mm = 0
-    image_count = 0
 
-    for f in os.listdir(OUTPUT_DIR):
+    for f in os.listdir(output_dir):
         if f.endswith('.png'):
-            with Image.open(os.path.join(OUTPUT_DIR, f)) as img:
-                width_mm = pixels_to_mm(img.width)
-                height_mm = pixels_to_mm(img.height)
-                available_images.append({
-                    "name": f,
-                    "width": width_mm,
-                    "height": height_mm
-                })
-                total_width_mm += width_mm
-                total_height_mm += height_mm
-                image_count += 1
-
-    avg_width_mm = round(total_width_mm / image_count) if image_count > 0 else 0
-    avg_height_mm = round(total_height_mm / image_count) if image_count > 0 else 0
-
-    return JSONResponse(content={
+            image_path = os.path.join(output_dir, f)
+            width_px, height_px, image_dpmm = png_header(image_path)
+            width_mm = pixels_to_mm(width_px, image_dpmm)
+            height_mm = pixels_to_mm(height_px, image_dpmm)
+            available_images.append({
+                "name": f,
+                "width": width_mm,
+                "height": height_mm
+            })
+
+    avg_width_mm = round(sum(image["width"] for image in available_images) / len(available_images)) if available_images else 0
+    avg_height_mm = round(sum(image["height"] for image in available_images) / len(available_images)) if available_images else 0
+
+    return {
         "available_images": available_images,
         "average_dimensions": {
             "width": avg_width_mm,
             "height": avg_height_mm
         }
-    })
+    }
 
 @app.on_event("shutdown")
 def cleanup():
-    global OUTPUT_DIR
-    if OUTPUT_DIR:
-        shutil.rmtree(OUTPUT_DIR, ignore_errors=True)
+    for output_dir in JOBS.values():
+        _remove_job_dir(output_dir)
+    JOBS.clear()
+    IMAGE_INDEX.clear()
+    RENDER_POOL.shutdown()
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    # Multiple workers require the app as an import string
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=8000,
+        workers=WEB_WORKERS,
+        loop="uvloop",
+        http="httptools",
+        limit_concurrency=64,
+        timeout_keep_alive=5,
+    )
\ No newline at end of file